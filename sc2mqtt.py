@@ -6,22 +6,60 @@ import requests
 from requests.exceptions import InvalidSchema
 from pyquery import PyQuery as pyq
 import re
+import os
+import math
 import json
+from datetime import datetime, timezone
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import threading
+import sqlite3
 import asyncio
+import signal
+import cProfile
+import pstats
+import tracemalloc
+from array import array
 from functools import partial
+from collections import namedtuple
+from types import MappingProxyType
 
 import paho.mqtt.client as mqtt
-from pathlib import Path
-
-import nest_asyncio
-nest_asyncio.apply()
 
 from colorlog import ColoredFormatter
 
 
+class DeferredQueueHandler(QueueHandler):
+    """QueueHandler that leaves message formatting to the listener thread."""
+    def prepare(self, record):
+        return record
+
+class RateLimitFilter(logging.Filter):
+    """Drop records carrying the same `ratekey` more often than once per interval.
+
+    Records without a `ratekey` (passed through `extra`) are never limited."""
+    def __init__(self, interval = 300):
+        super().__init__()
+        self.interval = interval
+        self.last = {}
+        self.passed = 0
+        self.suppressed = 0
+
+    def filter(self, record):
+        key = getattr(record, "ratekey", None)
+        if key is not None:
+            now = time.monotonic()
+            if key in self.last and now - self.last[key] < self.interval:
+                self.suppressed += 1
+                return False
+            self.last[key] = now
+        self.passed += 1
+        return True
+
+
 def setup_logger(name):
-    """Return a logger with a default ColoredFormatter."""
+    """Return a logger with a default ColoredFormatter, written out by a background thread."""
     formatter = ColoredFormatter(
         "%(log_color)s[%(levelname)-8s]-%(asctime)s%(reset)s %(cyan)s%(message)s%(reset)s",
         datefmt='%Y-%m-%d %H:%M:%S',
@@ -35,13 +73,40 @@ def setup_logger(name):
         }
     )
 
-    logger = logging.getLogger(name)
     handler = logging.StreamHandler()
     handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    logger.setLevel(logging.DEBUG)
+    logqueue = queue.SimpleQueue()
+    listener = QueueListener(logqueue, handler)
 
-    return logger
+    logger = logging.getLogger(name)
+    logger.addHandler(DeferredQueueHandler(logqueue))
+    logger.addFilter(RateLimitFilter())
+    logger.setLevel(logging.INFO)
+    listener.start()
+
+    return logger, listener
+
+def logLevel(cfo):
+    """Return the logLevel of the config file as number, None if it is unknown."""
+    level = cfo.get("logLevel", "INFO")
+    level = logging.getLevelName(level.upper()) if isinstance(level, str) else level
+    return level if isinstance(level, int) else None
+
+def configureLogging(cfo):
+    """Apply the logging settings from the config file to _LOGGER."""
+    level = logLevel(cfo)
+    if level is None:
+        _LOGGER.error("Unknown logLevel %r in config file, using INFO", cfo["logLevel"])
+        level = logging.INFO
+    _LOGGER.setLevel(level)
+    for f in _LOGGER.filters:
+        if isinstance(f, RateLimitFilter):
+            f.interval = cfo.get("logRateLimit", f.interval)
+
+def logStats():
+    """Return counters describing the logging overhead since startup."""
+    f = next(f for f in _LOGGER.filters if isinstance(f, RateLimitFilter))
+    return {"logEmitted": f.passed, "logSuppressed": f.suppressed, "logQueued": _LOG_LISTENER.queue.qsize()}
 
 STATLIMITS = [
     { "mask": r"LOCK_STATE.*DOOR", "check": "door_locked", "fail": 1 },
@@ -53,7 +118,7 @@ STATLIMITS = [
 ]
 
 #logging.basicConfig(level=logging.INFO)
-_LOGGER = setup_logger("s2m")
+_LOGGER, _LOG_LISTENER = setup_logger("s2m")
 
 async def main():
     try:
@@ -62,25 +127,16 @@ async def main():
 
         for el in ["user", "password", "broker"]:
             if el not in cfo:
-                _LOGGER.critical("No %s defined in config file" % el)
+                _LOGGER.critical("No %s defined in config file", el)
                 return False
-        ad = SkodaAdapter(cfo["user"], cfo["password"])
-        await ad.init()
-        mqttc = mqtt.Client()
-        mqttc.connect(cfo["broker"])
-        mqttc.loop_start()
-        
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(
-            asyncio.gather(
-               ad.updateValues(mqttc),
-               ad.loopRefreshTokens()
-            )
-        )
-        loop.close()
+        configureLogging(cfo)
+        await Daemon(cfo, "config.json").run()
 
         return True
 
+    except ConfigError as e:
+        _LOGGER.critical("Invalid config file: %s", e)
+        return False
 
     except FileNotFoundError:
         _LOGGER.critical("Config file not found!")
@@ -103,6 +159,809 @@ async def configSample():
 
 
 
+def parseUtc(ts):
+    """Return the unix time of a VW timestamp like 2020-10-06T12:34:56Z, None if invalid."""
+    try:
+        return datetime.strptime(ts, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo = timezone.utc).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """Great circle distance in meters."""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 6371000 * 2 * math.asin(math.sqrt(a))
+
+def checkPositive(types = (int, float), **values):
+    """Raise ValueError unless all values are positive numbers of `types`."""
+    for name, value in values.items():
+        if isinstance(value, bool) or not isinstance(value, types) or value <= 0:
+            raise ValueError("%s must be a positive %s, not %r" % (name, "integer" if types is int else "number", value))
+
+
+class GeofenceIndex:
+    """Circular geofences, indexed in a grid of `cellSize` degrees.
+
+    Every zone is registered in all cells its bounding box touches, so a
+    lookup only checks the few zones of one cell, however many there are."""
+    def __init__(self, zones, cellSize = 0.05):
+        self.cellSize = cellSize
+        self.cells = {}
+        for zone in zones:
+            dlat = zone["radius"] / 111320
+            dlon = zone["radius"] / (111320 * max(math.cos(math.radians(zone["latitude"])), 0.01))
+            for i in range(self.cell(zone["latitude"] - dlat), self.cell(zone["latitude"] + dlat) + 1):
+                for j in range(self.cell(zone["longitude"] - dlon), self.cell(zone["longitude"] + dlon) + 1):
+                    self.cells.setdefault((i, j), []).append(zone)
+
+    @classmethod
+    def load(cls, path):
+        # [{"name": "depot", "latitude": 50.1, "longitude": 14.4, "radius": 200}, ...]
+        with open(path, "r") as f:
+            return cls(json.load(f))
+
+    def cell(self, deg):
+        return math.floor(deg / self.cellSize)
+
+    def zonesAt(self, lat, lon):
+        candidates = self.cells.get((self.cell(lat), self.cell(lon)), [])
+        return [z["name"] for z in candidates if distance(lat, lon, z["latitude"], z["longitude"]) <= z["radius"]]
+
+
+class MqttLink:
+    """MQTT connection routing subscribed topics to coroutines on the asyncio loop.
+
+    paho calls back from its own network thread, so handlers are scheduled
+    onto `loop`. Subscriptions are renewed on every (re)connect, also after
+    connect() moved the link to another broker."""
+    def __init__(self, loop):
+        self.loop = loop
+        self.routes = {}
+        self.client = None
+        self.broker = None
+        self.lastInfo = None
+
+    def connect(self, broker):
+        # the current client keeps working until the new one is connected, raises OSError if it can't
+        client = mqtt.Client()
+        client.on_connect = self.onConnect
+        for topic in self.routes:
+            client.message_callback_add(topic, self.onMessage)
+        client.connect(broker)
+        client.loop_start()
+        old, self.client = self.client, client
+        self.broker = broker
+        self.lastInfo = None
+        if old:
+            old.disconnect()
+            old.loop_stop()
+
+    def publish(self, topic, payload = None):
+        self.lastInfo = self.client.publish(topic, payload)
+        return self.lastInfo
+
+    def close(self, timeout = 5):
+        # blocking; messages are sent in order, so waiting for the last one flushes all
+        try:
+            if self.lastInfo:
+                self.lastInfo.wait_for_publish(timeout)
+        except (ValueError, RuntimeError) as e:
+            _LOGGER.warning("Could not flush MQTT messages: %s", e)
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def add(self, topic, handler):
+        # handler: coroutine function taking (topic, payload)
+        self.routes[topic] = handler
+        if self.client:
+            self.client.message_callback_add(topic, self.onMessage)
+            self.client.subscribe(topic)
+
+    def onConnect(self, client, userdata, flags, rc):
+        for topic in self.routes:
+            client.subscribe(topic)
+
+    def onMessage(self, client, userdata, msg):
+        for topic, handler in self.routes.items():
+            if mqtt.topic_matches_sub(topic, msg.topic):
+                fut = asyncio.run_coroutine_threadsafe(handler(msg.topic, msg.payload), self.loop)
+                fut.add_done_callback(partial(self.handlerDone, msg.topic))
+
+    def handlerDone(self, topic, fut):
+        if not fut.cancelled() and fut.exception() is not None:
+            _LOGGER.error("Handling message on %s failed: %r", topic, fut.exception())
+
+
+class HistoryStore:
+    """Local time-series history of vehicle values, kept in SQLite (WAL mode).
+
+    Values are collected with record() during a poll cycle and written in a
+    single transaction by flush(). Only changed values are stored; query()
+    also returns the last value before the requested range, so the value at
+    any point in time can be told. Rows older than `downsampleDays` are
+    thinned out to one per hour, rows older than `retentionDays` dropped."""
+    def __init__(self, path = "sc2mqtt.db", retentionDays = 365, downsampleDays = 7):
+        checkPositive(retentionDays = retentionDays, downsampleDays = downsampleDays)
+        self.retention = retentionDays * 86400
+        self.downsample = downsampleDays * 86400
+        self.pending = []
+        self.last = {}
+        self.pruned = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread = False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS history (vin TEXT, field TEXT, ts REAL, value)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS history_idx ON history (vin, field, ts)")
+        for vin, field, value in self.db.execute("SELECT vin, field, value FROM history WHERE rowid IN (SELECT max(rowid) FROM history GROUP BY vin, field)"):
+            self.last[(vin, field)] = value
+
+    def record(self, vin, field, value, ts = None, changesOnly = True):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            pass
+        if changesOnly and self.last.get((vin, field)) == value:
+            return
+        self.last[(vin, field)] = value
+        self.pending.append((vin, field, ts or time.time(), value))
+
+    async def flush(self):
+        rows, self.pending = self.pending, []
+        if rows:
+            await asyncio.get_running_loop().run_in_executor(None, self.write, rows)
+        return len(rows)
+
+    def write(self, rows):
+        with self.lock:
+            with self.db:
+                self.db.executemany("INSERT INTO history VALUES (?, ?, ?, ?)", rows)
+            if time.time() - self.pruned > 86400:
+                self.prune()
+
+    def close(self):
+        # waits for a write still running in the executor
+        with self.lock:
+            self.db.close()
+
+    def prune(self):
+        now = time.time()
+        with self.db:
+            # keep the last row of every hour...
+            cutoff = now - self.downsample
+            self.db.execute("DELETE FROM history WHERE ts < ? AND rowid NOT IN (SELECT max(rowid) FROM history WHERE ts < ? GROUP BY vin, field, CAST(ts / 3600 AS INTEGER))", (cutoff, cutoff))
+            # ...and the last row before the retention period
+            cutoff = now - self.retention
+            self.db.execute("DELETE FROM history WHERE ts < ? AND rowid NOT IN (SELECT max(rowid) FROM history WHERE ts < ? GROUP BY vin, field)", (cutoff, cutoff))
+        self.pruned = now
+
+    def query(self, vin, field, t1, t2):
+        """Return [(ts, value), ...] of `field` for `vin` between t1 and t2."""
+        with self.lock:
+            before = self.db.execute("SELECT ts, value FROM history WHERE vin = ? AND field = ? AND ts < ? ORDER BY ts DESC LIMIT 1", (vin, field, t1)).fetchall()
+            return before + self.db.execute("SELECT ts, value FROM history WHERE vin = ? AND field = ? AND ts BETWEEN ? AND ? ORDER BY ts", (vin, field, t1, t2)).fetchall()
+
+    async def onQuery(self, mqttc, topic, payload):
+        # {"vin": ..., "field": ..., "from": ts, "to": ts, "id": ...} -> skoda2mqtt/_history/result
+        req = json.loads(payload)
+        t2 = req.get("to", time.time())
+        t1 = req.get("from", t2 - 86400)
+        rows = await asyncio.get_running_loop().run_in_executor(None, self.query, req["vin"], req["field"], t1, t2)
+        mqttc.publish("skoda2mqtt/_history/result", json.dumps({
+            "id": req.get("id"),
+            "vin": req["vin"],
+            "field": req["field"],
+            "t": [r[0] for r in rows],
+            "v": [r[1] for r in rows]
+        }, separators = (",", ":")))
+
+
+class RingBuffer:
+    """Fixed-size buffer of (timestamp, value) samples, oldest overwritten first."""
+    __slots__ = ("ts", "values", "pos", "count")
+
+    def __init__(self, capacity):
+        self.ts = array("d", [0.0]) * capacity
+        self.values = array("d", [0.0]) * capacity
+        self.pos = 0
+        self.count = 0
+
+    def append(self, ts, value):
+        self.ts[self.pos] = ts
+        self.values[self.pos] = value
+        self.pos = (self.pos + 1) % len(self.ts)
+        if self.count < len(self.ts):
+            self.count += 1
+
+    def since(self, t1):
+        size = len(self.ts)
+        idx = [(self.pos - self.count + i) % size for i in range(self.count)]
+        return [(self.ts[i], self.values[i]) for i in idx if self.ts[i] >= t1]
+
+
+class RecentValues:
+    """Ring buffers of recent numeric values per (vin, field).
+
+    Every buffer preallocates `capacity` samples; buffers beyond what fits
+    into `maxBytes` for the whole fleet are not created."""
+    SAMPLESIZE = 16 # timestamp and value, both doubles
+
+    def __init__(self, capacity = 1440, maxBytes = 8 * 1024 * 1024):
+        checkPositive(int, capacity = capacity)
+        checkPositive(maxBytes = maxBytes)
+        self.capacity = capacity
+        self.maxBytes = maxBytes
+        self.buffers = {}
+        self.rejected = set()
+
+    def bytesUsed(self):
+        return len(self.buffers) * self.capacity * self.SAMPLESIZE
+
+    def record(self, vin, field, value, ts = None):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return
+        buf = self.buffers.get((vin, field))
+        if buf is None:
+            if self.bytesUsed() + self.capacity * self.SAMPLESIZE > self.maxBytes:
+                if (vin, field) not in self.rejected:
+                    self.rejected.add((vin, field))
+                    _LOGGER.warning("Recent values memory limit (%d bytes) reached, not keeping %s of %s", self.maxBytes, field, vin)
+                return
+            buf = self.buffers[(vin, field)] = RingBuffer(self.capacity)
+        buf.append(ts or time.time(), value)
+
+    def stats(self):
+        return {"recentBytes": self.bytesUsed(), "recentMaxBytes": self.maxBytes, "recentSeries": len(self.buffers), "recentRejected": len(self.rejected)}
+
+    async def onQuery(self, mqttc, topic, payload):
+        # {"vin": ..., "field": ..., "seconds": 3600, "id": ...} -> skoda2mqtt/_recent/result
+        req = json.loads(payload)
+        buf = self.buffers.get((req["vin"], req["field"]))
+        rows = buf.since(time.time() - req.get("seconds", 3600)) if buf else []
+        mqttc.publish("skoda2mqtt/_recent/result", json.dumps({
+            "id": req.get("id"),
+            "vin": req["vin"],
+            "field": req["field"],
+            "t": [r[0] for r in rows],
+            "v": [r[1] for r in rows]
+        }, separators = (",", ":")))
+
+
+def writeJsonAtomic(path, data):
+    """Write `data` as JSON to `path`, never leaving a half-written file behind."""
+    writeFileAtomic(path, json.dumps(data))
+
+def writeFileAtomic(path, text):
+    tmp = "%s.tmp" % path
+    with open(tmp, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class TripStatistics:
+    """Running per-VIN trip aggregates, updated trip by trip.
+
+    Only trips with a tripID above the last one seen (the cursor) are
+    added, so nothing is counted twice and old trips are never looked at
+    again. Daily and monthly rollups are kept for `days` days and `months`
+    months. Cursors and aggregates survive restarts in `stateFile`, kept
+    apart per `tripType` since every type has trips of its own."""
+    def __init__(self, tripType, stateFile = "sc2mqtt.trips.json", days = 31, months = 24):
+        self.tripType = tripType
+        self.stateFile = stateFile
+        self.days = days
+        self.months = months
+        try:
+            with open(stateFile, "r") as f:
+                self.state = json.load(f)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            self.state = {}
+        self.vehicles = self.state.setdefault(tripType, {})
+
+    def save(self):
+        writeJsonAtomic(self.stateFile, self.state)
+
+    def cursor(self, vin):
+        return self.vehicles.get(vin, {}).get("cursor")
+
+    def add(self, vin, trips):
+        """Fold the trips newer than the cursor in, return them."""
+        stats = self.vehicles.setdefault(vin, {"cursor": None, "lastDistance": 0, "total": {}, "daily": {}, "monthly": {}})
+        added = sorted([t for t in trips if stats["cursor"] is None or t["tripID"] > stats["cursor"]], key = lambda t: t["tripID"])
+        for trip in added:
+            ts = trip.get("timestamp", "")
+            for bucket in [stats["total"], stats["daily"].setdefault(ts[:10], {}), stats["monthly"].setdefault(ts[:7], {})]:
+                self.fold(bucket, trip)
+            stats["cursor"] = trip["tripID"]
+            stats["lastDistance"] = trip.get("mileage", 0)
+        for rollup, keep in [("daily", self.days), ("monthly", self.months)]:
+            for key in sorted(stats[rollup])[:-keep]:
+                del stats[rollup][key]
+        return added
+
+    @staticmethod
+    def fold(bucket, trip):
+        distance = trip.get("mileage") or 0
+        bucket["trips"] = bucket.get("trips", 0) + 1
+        bucket["distance"] = bucket.get("distance", 0) + distance
+        bucket["minutes"] = bucket.get("minutes", 0) + (trip.get("traveltime") or 0)
+        # consumptions come in 1/10 l (kWh) per 100 km
+        bucket["fuel"] = bucket.get("fuel", 0) + (trip.get("averageFuelConsumption") or 0) / 10 * distance / 100
+        bucket["energy"] = bucket.get("energy", 0) + (trip.get("averageElectricEngineConsumption") or 0) / 10 * distance / 100
+
+    @staticmethod
+    def summary(bucket):
+        bucket = bucket or {}
+        distance = bucket.get("distance", 0)
+        return {
+            "trips": bucket.get("trips", 0),
+            "distance": distance,
+            "averageSpeed": round(distance / bucket["minutes"] * 60, 1) if bucket.get("minutes") else 0,
+            "averageConsumption": round(bucket["fuel"] / distance * 100, 1) if distance else 0,
+            "averageElectricConsumption": round(bucket["energy"] / distance * 100, 1) if distance else 0,
+        }
+
+
+class WakeupScheduler:
+    """Send status update requests ("wake-ups") to the cars within a budget.
+
+    A token bucket allows `budget` wake-ups per `window` seconds for the whole
+    account. Once the backend throttles us, nothing is sent for
+    `throttleWait` seconds. Cars whose data is older than `minAge` are woken
+    up stalest first, each at most once per `minAge`. The bucket and the
+    per-VIN timestamps are kept in `stateFile` across restarts."""
+    def __init__(self, adapter, budget = 4, window = 3600, minAge = 3600, throttleWait = 1800, stateFile = "sc2mqtt.wakeups.json"):
+        checkPositive(budget = budget, window = window, minAge = minAge, throttleWait = throttleWait)
+        self.adapter = adapter
+        self.budget = budget
+        self.window = window
+        self.minAge = minAge
+        self.throttleWait = throttleWait
+        self.stateFile = stateFile
+        try:
+            with open(stateFile, "r") as f:
+                state = json.load(f)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            state = {}
+        self.tokens = state.get("tokens", budget)
+        self.refilled = state.get("refilled", time.time())
+        self.throttledUntil = state.get("throttledUntil", 0)
+        self.lastWakeup = state.get("lastWakeup", {})
+
+    def save(self):
+        writeJsonAtomic(self.stateFile, {
+            "tokens": self.tokens,
+            "refilled": self.refilled,
+            "throttledUntil": self.throttledUntil,
+            "lastWakeup": self.lastWakeup
+        })
+
+    def candidates(self, now):
+        ages = dict([(vin, self.adapter.dataAge(vin, now)) for vin in self.adapter.vehicles])
+        due = [vin for vin, age in ages.items() if age >= self.minAge and now - self.lastWakeup.get(vin, 0) >= self.minAge]
+        return sorted(due, key = lambda vin: ages[vin], reverse = True)
+
+    async def step(self):
+        now = time.time()
+        self.tokens = min(self.budget, self.tokens + (now - self.refilled) * self.budget / self.window)
+        self.refilled = now
+        self.adapter.stats["wakeupTokens"] = round(self.tokens, 2)
+        if now < self.throttledUntil:
+            return
+        sent = False
+        for vin in self.candidates(now):
+            if self.tokens < 1:
+                break
+            self.tokens -= 1
+            self.lastWakeup[vin] = now
+            sent = True
+            try:
+                await self.adapter.requestStatusUpdate(vin)
+                _LOGGER.info("Requested status update from %s", vin)
+            except VWThrottledException:
+                self.throttledUntil = now + self.throttleWait
+                _LOGGER.warning("Status update requests throttled, pausing them for %d s", self.throttleWait)
+                break
+            except HTTPCodeException as e:
+                _LOGGER.warning("Status update request for %s failed: %s", vin, e.message)
+        if sent:
+            self.save()
+
+
+class Profiler:
+    """Diagnostics on request, written as text files to `directory`.
+
+    cpu: cProfile of the event loop thread for `seconds` (work done in the
+    executor threads is not seen); memory: tracemalloc snapshot, compared
+    to the previous one; tasks: stacks of all asyncio tasks; stop: end
+    tracemalloc. Nothing is traced until requested, only tracemalloc keeps
+    running after the first memory request to have something to compare to."""
+    def __init__(self, directory = "profiles", frames = 10):
+        self.directory = directory
+        self.frames = frames
+        self.profiling = False
+        self.lastSnapshot = None
+
+    def output(self, mode):
+        os.makedirs(self.directory, exist_ok = True)
+        return os.path.join(self.directory, "%s-%s.txt" % (mode, time.strftime("%Y%m%d-%H%M%S")))
+
+    async def run(self, mode, seconds = 30):
+        """Run the diagnostics `mode`, return the file written (if any)."""
+        loop = asyncio.get_running_loop()
+        if mode == "cpu":
+            return await self.cpu(seconds)
+        elif mode == "memory":
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.frames)
+            return await loop.run_in_executor(None, self.memory, tracemalloc.take_snapshot())
+        elif mode == "tasks":
+            return self.tasks()
+        elif mode == "stop":
+            tracemalloc.stop()
+            self.lastSnapshot = None
+            _LOGGER.info("Memory tracing stopped")
+        else:
+            _LOGGER.warning("Unknown profiling mode %s", mode)
+
+    async def cpu(self, seconds):
+        if self.profiling:
+            _LOGGER.warning("CPU profile already running")
+            return None
+        self.profiling = True
+        _LOGGER.info("Profiling CPU for %d s", seconds)
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            prof.disable()
+            self.profiling = False
+        path = self.output("cpu")
+        with open(path, "w") as f:
+            pstats.Stats(prof, stream = f).sort_stats("cumulative").print_stats(50)
+        prof.dump_stats(path[:-4] + ".prof")
+        _LOGGER.info("CPU profile written to %s", path)
+        return path
+
+    def memory(self, snapshot):
+        # blocking, run it in an executor
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+        path = self.output("memory")
+        with open(path, "w") as f:
+            if self.lastSnapshot:
+                f.write("Top 50 changes since %s:\n" % self.lastSnapshot[0])
+                for stat in snapshot.compare_to(self.lastSnapshot[1], "lineno")[:50]:
+                    f.write("%s\n" % stat)
+                f.write("\n")
+            f.write("Top 50 allocations:\n")
+            for stat in snapshot.statistics("lineno")[:50]:
+                f.write("%s\n" % stat)
+        self.lastSnapshot = (time.strftime("%Y-%m-%d %H:%M:%S"), snapshot)
+        _LOGGER.info("Memory snapshot written to %s", path)
+        return path
+
+    def tasks(self):
+        path = self.output("tasks")
+        with open(path, "w") as f:
+            for task in asyncio.all_tasks():
+                f.write("%r\n" % task)
+                task.print_stack(file = f)
+                f.write("\n")
+        _LOGGER.info("Task stacks written to %s", path)
+        return path
+
+
+class TaskSupervisor:
+    """Runs named tasks on the event loop and restarts them when they fail.
+
+    A failed task is restarted after a backoff doubling from `minBackoff`
+    up to `maxBackoff` seconds; the backoff is reset once a task ran longer
+    than `maxBackoff`. Periodic tasks started with every() back off at least
+    their interval and also report how long their last iteration took."""
+    def __init__(self, minBackoff = 5, maxBackoff = 600):
+        self.minBackoff = minBackoff
+        self.maxBackoff = maxBackoff
+        self.tasks = {}
+        self.health = {}
+
+    def start(self, name, factory, minBackoff = 0):
+        # factory: callable returning the coroutine to run, called again on every restart
+        self.stop(name)
+        self.health[name] = {"state": "running", "restarts": 0, "lastError": None}
+        self.tasks[name] = asyncio.ensure_future(self.supervise(name, factory, max(self.minBackoff, minBackoff)))
+
+    def every(self, name, step, interval):
+        """Run coroutine function `step` every `interval` seconds."""
+        # a failed step is not retried sooner than the next one would have run
+        self.start(name, partial(self.repeat, name, step, interval), interval)
+
+    async def repeat(self, name, step, interval):
+        while True:
+            started = time.perf_counter()
+            await step()
+            self.health[name]["iterationMs"] = round((time.perf_counter() - started) * 1000, 1)
+            self.health[name]["lastIteration"] = time.time()
+            await asyncio.sleep(interval)
+
+    async def supervise(self, name, factory, minBackoff):
+        health = self.health[name]
+        backoff = minBackoff
+        while True:
+            started = time.monotonic()
+            health["state"] = "running"
+            try:
+                await factory()
+                health["state"] = "finished"
+                return
+            except asyncio.CancelledError:
+                health["state"] = "stopped"
+                raise
+            except Exception as e:
+                if time.monotonic() - started > self.maxBackoff:
+                    backoff = minBackoff
+                health["state"] = "backoff"
+                health["restarts"] += 1
+                health["lastError"] = repr(e)
+                _LOGGER.error("Task %s failed, restarting in %d s", name, backoff, exc_info = True)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, max(self.maxBackoff, minBackoff))
+
+    def stop(self, name):
+        task = self.tasks.pop(name, None)
+        if task:
+            task.cancel()
+            self.health.pop(name, None)
+
+    async def stopAll(self):
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions = True)
+        self.tasks = {}
+
+
+class Daemon:
+    """Runs the MQTT link, the SkodaAdapter and their tasks.
+
+    config.json is reloaded on SIGHUP or when it changes on disk. Only what
+    a changed setting affects is restarted: a new broker moves the MQTT
+    link, new credentials get a new SkodaAdapter (and login), a new
+    "wakeup" section restarts the wake-up scheduler. Everything else is
+    applied in place, so the pollers keep their tokens and cookies."""
+    def __init__(self, cfo, configFile):
+        self.cfo = cfo
+        self.configFile = configFile
+        self.configMtime = os.stat(configFile).st_mtime
+        self.loop = asyncio.get_running_loop()
+        self.mqttc = MqttLink(self.loop)
+        self.ad = None
+        self.tasks = TaskSupervisor()
+        self.profiler = Profiler()
+        self.done = self.loop.create_future()
+
+    async def run(self):
+        self.mqttc.add("skoda2mqtt/_history/get", self.onHistoryQuery)
+        self.mqttc.add("skoda2mqtt/_recent/get", self.onRecentQuery)
+        self.mqttc.add("skoda2mqtt/_admin/profile", self.onProfile)
+        self.mqttc.add("skoda2mqtt/+/refresh", self.onRefresh)
+        self.mqttc.add("skoda2mqtt/refresh", self.onRefresh)
+        built = self.prepare(self.cfo, None)
+        self.mqttc.connect(self.cfo["broker"])
+        self.ad = SkodaAdapter(self.cfo["user"], self.cfo["password"])
+        await self.configure(self.cfo, built)
+
+        # publish what we knew before the restart, logging in may take minutes
+        age = self.ad.loadSnapshot()
+        if age is not None:
+            for vin in self.ad.vehicleStates:
+                self.ad.publishVehicle(self.mqttc, vin, record = False)
+            _LOGGER.info("Published last known state of %d vehicles (snapshot taken %d s ago)", len(self.ad.vehicleStates), age)
+
+        self.tasks.start("adapter", self.runAdapter)
+        self.startWakeups()
+        self.tasks.start("configWatch", self.watchConfig)
+        self.tasks.every("stats", self.publishStats, 60)
+        for sig, handler in [
+                ("SIGHUP", lambda: asyncio.ensure_future(self.reload())),
+                ("SIGTERM", self.shutdown),
+                ("SIGINT", self.shutdown),
+                ("SIGUSR1", partial(self.profileOnSignal, "tasks", "cpu")),
+                ("SIGUSR2", partial(self.profileOnSignal, "memory"))]:
+            try:
+                self.loop.add_signal_handler(getattr(signal, sig), handler)
+            except (NotImplementedError, AttributeError): # no signals on windows
+                pass
+        try:
+            await self.done
+        finally:
+            _LOGGER.info("Shutting down...")
+            await self.tasks.stopAll()
+            if self.ad.history:
+                await self.ad.history.flush()
+                self.ad.history.close()
+            self.ad.saveSnapshot()
+            await self.publishStats()
+            await self.loop.run_in_executor(None, self.mqttc.close)
+
+    def shutdown(self):
+        if not self.done.done():
+            self.done.set_result(True)
+
+    async def runAdapter(self):
+        await self.ad.init()
+        self.tasks.every("poller", partial(self.ad.updateValues, self.mqttc), 60)
+        self.tasks.start("tokens", self.ad.loopRefreshTokens)
+        self.startTrips()
+
+    def startTrips(self):
+        if self.ad.trips:
+            self.tasks.every("trips", partial(self.ad.updateTrips, self.mqttc), self.cfo.get("tripInterval", 600))
+        else:
+            self.tasks.stop("trips")
+
+    async def publishStats(self):
+        stats = dict(self.ad.stats)
+        stats.update(logStats())
+        stats.update(self.ad.recent.stats())
+        stats["tasks"] = self.tasks.health
+        self.mqttc.publish("skoda2mqtt/_stats", json.dumps(stats))
+
+    def startWakeups(self):
+        if "wakeup" in self.cfo:
+            self.tasks.every("wakeup", WakeupScheduler(self.ad, **self.cfo["wakeup"]).step, 60)
+        else:
+            self.tasks.stop("wakeup")
+
+    def prepare(self, cfo, old):
+        """Validate cfo and build the components whose settings differ from old (None: all of them).
+
+        Nothing running is touched, so an invalid setting raises ConfigError
+        and leaves the current configuration in effect."""
+        missing = [el for el in ["user", "password", "broker"] if el not in cfo]
+        if missing:
+            raise ConfigError("no %s defined" % ", ".join(missing))
+        if logLevel(cfo) is None and old is not None:
+            # at startup configureLogging() falls back to INFO, a reload keeps the running level
+            raise ConfigError("unknown logLevel %r" % cfo["logLevel"])
+        changed = lambda key: old is None or cfo.get(key) != old.get(key)
+        built = {}
+        try:
+            if "wakeup" in cfo and changed("wakeup"):
+                WakeupScheduler(None, **cfo["wakeup"]) # only checked, started with the adapter
+            if changed("recent"):
+                built["recent"] = RecentValues(**cfo.get("recent", {}))
+            if changed("geofences"):
+                built["geofences"] = GeofenceIndex.load(cfo["geofences"]) if "geofences" in cfo else None
+            # last, it opens the database
+            if changed("history"):
+                built["history"] = HistoryStore(**cfo["history"]) if "history" in cfo else None
+        except (TypeError, OSError, ValueError, KeyError, sqlite3.Error) as e:
+            raise ConfigError(repr(e))
+        return built
+
+    async def configure(self, cfo, built):
+        # settings that can be changed in place, built: components from prepare()
+        configureLogging(cfo)
+        self.profiler.directory = cfo.get("profileDir", "profiles")
+        ad = self.ad
+        ad.refreshDebounce = cfo.get("refreshDebounce", SkodaAdapter.refreshDebounce)
+        ad.refreshMinInterval = cfo.get("refreshMinInterval", SkodaAdapter.refreshMinInterval)
+        ad.snapshotFile = cfo.get("snapshotFile", SkodaAdapter.snapshotFile)
+        ad.snapshotInterval = cfo.get("snapshotInterval", SkodaAdapter.snapshotInterval)
+        if "recent" in built:
+            ad.recent = built["recent"]
+        if "geofences" in built:
+            ad.geofences = built["geofences"]
+        ad.config["tripType"] = cfo.get("tripType", "none")
+        if ad.config["tripType"] == "none":
+            ad.trips = None
+        elif ad.trips is None or ad.trips.tripType != ad.config["tripType"]:
+            ad.trips = TripStatistics(ad.config["tripType"])
+        if "history" in built:
+            replaced, ad.history = ad.history, built["history"]
+            if replaced:
+                await replaced.flush()
+                replaced.close()
+
+    async def reload(self):
+        try:
+            mtime = os.stat(self.configFile).st_mtime
+        except FileNotFoundError as e:
+            _LOGGER.error("Not reloading config: %s", e)
+            return
+        try:
+            with open(self.configFile, "r") as cfile:
+                cfo = json.load(cfile)
+            built = self.prepare(cfo, self.cfo)
+        except (FileNotFoundError, json.decoder.JSONDecodeError, ConfigError) as e:
+            _LOGGER.error("Not reloading config: %s", e)
+            self.configMtime = mtime # the old settings stay until the file is changed again
+            return
+        old = self.cfo
+        changed = sorted(set([k for k in set(cfo) | set(old) if cfo.get(k) != old.get(k)]))
+        if not changed:
+            self.configMtime = mtime
+            return
+
+        if cfo["broker"] != old["broker"]:
+            _LOGGER.info("Moving to broker %s", cfo["broker"])
+            try:
+                # DNS lookup and connect block, keep polls and handlers going meanwhile
+                await self.loop.run_in_executor(None, self.mqttc.connect, cfo["broker"])
+            except OSError as e:
+                # configMtime stays, so the next check of the file tries again
+                _LOGGER.error("Not reloading config: could not connect to broker %s: %r", cfo["broker"], e)
+                if built.get("history"):
+                    built["history"].close()
+                return
+            self.ad.configured = [] # announce the sensors to the new broker, too
+
+        # everything is validated and connected, apply it
+        self.cfo, self.configMtime = cfo, mtime
+        _LOGGER.info("Config reloaded, changed: %s", ", ".join(changed))
+        relogin = cfo["user"] != old["user"] or cfo["password"] != old["password"]
+        if relogin:
+            _LOGGER.info("Credentials changed, logging in again")
+            for name in ["adapter", "poller", "tokens", "trips"]:
+                self.tasks.stop(name)
+            ad = SkodaAdapter(cfo["user"], cfo["password"])
+            ad.vehicleStates, ad.stateTimes = self.ad.vehicleStates, self.ad.stateTimes
+            ad.history, ad.recent, ad.geofences, ad.trips = self.ad.history, self.ad.recent, self.ad.geofences, self.ad.trips
+            self.ad = ad
+        await self.configure(cfo, built)
+        if relogin:
+            self.tasks.start("adapter", self.runAdapter)
+            self.startWakeups()
+        else:
+            if cfo.get("wakeup") != old.get("wakeup"):
+                self.startWakeups()
+            if [k for k in ["tripType", "tripInterval"] if cfo.get(k) != old.get(k)]:
+                self.startTrips()
+
+    async def watchConfig(self):
+        while True:
+            await asyncio.sleep(self.cfo.get("configWatchInterval", 10))
+            try:
+                if os.stat(self.configFile).st_mtime != self.configMtime:
+                    await self.reload()
+            except FileNotFoundError:
+                pass
+
+    async def onHistoryQuery(self, topic, payload):
+        if self.ad.history:
+            await self.ad.history.onQuery(self.mqttc, topic, payload)
+
+    async def onRecentQuery(self, topic, payload):
+        await self.ad.recent.onQuery(self.mqttc, topic, payload)
+
+    async def onRefresh(self, topic, payload):
+        await self.ad.onRefresh(self.mqttc, topic, payload)
+
+    def profileOnSignal(self, *modes):
+        for mode in modes:
+            asyncio.ensure_future(self.onProfile(None, mode.encode()))
+
+    async def onProfile(self, topic, payload):
+        # {"mode": "cpu"|"memory"|"tasks"|"stop", "seconds": 30} or just the mode
+        try:
+            req = json.loads(payload)
+        except ValueError:
+            req = payload.decode()
+        if not isinstance(req, dict):
+            req = {"mode": req}
+        path = await self.profiler.run(req.get("mode", "cpu"), req.get("seconds", 30))
+        self.mqttc.publish("skoda2mqtt/_admin/profile/result", json.dumps({"mode": req.get("mode", "cpu"), "file": path}))
+
+
+class ConfigError(Exception):
+    """Invalid setting in the config file."""
+
 class VWThrottledException(Exception):
     # attributes:
     #   message
@@ -124,6 +983,58 @@ class RedirectedToSkodaException(Exception):
     def __init__(self, url):
         self.url = code
 
+Endpoint = namedtuple("Endpoint", ["url", "profile", "method"])
+
+class RequestProfiles:
+    """Read-only header sets per client type, built once per account.
+
+    "app" (with its variants "carport" and "rights") is the okhttp based
+    Skoda app calling the vehicle APIs, "tokenservice" and "mbboauth" are
+    the token services, "browser" is the OIDC login. setBearer() builds the
+    authorized sets anew and swaps them in with one assignment, so a
+    request running concurrently sees either the old or the new token."""
+    AUTHORIZED = ["app", "carport", "rights"]
+
+    def __init__(self, config):
+        app = {
+            "User-Agent": "okhttp/3.7.0",
+            "X-App-Version": config["xappversion"],
+            "X-App-Name": config["xappname"],
+            "Accept-charset": "UTF-8",
+            "Accept": "application/json",
+        }
+        self.templates = dict([(name, MappingProxyType(h)) for name, h in {
+            "app": app,
+            "carport": dict(app, **{"X-Market": "de_DE"}),
+            "rights": dict(app, Accept = "application/json, application/vnd.vwg.mbb.operationList_v3_0_2+xml, application/vnd.vwg.mbb.genericError_v1_0_2+xml"),
+            "tokenservice": {
+                "X-App-version": config["xappversion"],
+                "content-type": "application/x-www-form-urlencoded",
+                "x-app-name": config["xappname"],
+                "accept": "application/json"
+            },
+            "mbboauth": {
+                "User-Agent": "okhttp/3.7.0",
+                "X-App-Version": config["xappversion"],
+                "X-App-Name": config["xappname"],
+                "X-Client-Id": config["xClientId"],
+                "Host": "mbboauth-1d.prd.ece.vwg-connect.com",
+            },
+            "browser": {
+                "user-agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 13_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148",
+                "accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+                "accept-language": "de-de",
+            },
+        }.items()])
+        self.headers = self.templates
+
+    def setBearer(self, token):
+        headers = dict(self.headers)
+        for name in self.AUTHORIZED:
+            headers[name] = MappingProxyType(dict(self.templates[name], Authorization = "Bearer " + token))
+        self.headers = headers
+
+
 class SkodaAdapter:
     elems2tokens = {
             'state': 'state',
@@ -214,16 +1125,20 @@ class SkodaAdapter:
 
     curReq = ""
 
-    vwtokens = {}
-
     jar = ""
-    vehicles = []
-    vehicleData = {}
-    vehicleRights = {}
-    vehicleHomeRegions = {}
-    vehicleStates = {}
 
-    throttle_wait = 0
+    refreshDebounce = 2
+    refreshMinInterval = 30
+    snapshotFile = "sc2mqtt.state.json"
+    snapshotInterval = 300
+    snapshotSaved = 0
+    throttleWait = 900
+    throttledUntil = 0
+
+    history = None
+    recent = None
+    geofences = None
+    trips = None
 
     statesArray = [
         {
@@ -276,26 +1191,18 @@ class SkodaAdapter:
         },
     ]
 
-    configured = []
-    
-    HEADERS = lambda self,x: {
-                    "User-Agent": "okhttp/3.7.0",
-                    #"content-type": "application/x-www-form-urlencoded",
-                    "X-Client-Id": self.config["xClientId"],
-                    "X-App-Version": self.config["xappversion"],
-                    "X-App-Name": self.config["xappname"],
-                    "Accept-charset": "UTF-8",
-                    "Accept": "application/json,*/*",
-                } if x == "SESSION" else {
-                    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3',
-                    'Content-Type': 'application/x-www-form-urlencoded',
-                    'User-Agent': 'Mozilla/5.0 (Linux; Android 6.0.1; D5803 Build/23.5.A.1.291; wv) AppleWebKit/537.36 (KHTML, like Gecko) Version/4.0 Chrome/63.0.3239.111 Mobile Safari/537.36'
-                    #"user-agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 13_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148",
-                    #"accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-                    #"accept-language": "de-de",
-                    #"Authorization": "Bearer " + self.vwtokens["atoken"],
-                    #"acccept-encoding": "gzip, deflate, br"
-                }
+    endpoints = dict([(e["path"], Endpoint(e["url"].split("?")[0], "app", "GET")) for e in statesArray])
+    endpoints.update({
+        "requests": Endpoint("$homeregion/fs-car/bs/vsr/v1/$type/$country/vehicles/$vin/requests", "app", "POST"),
+        "carportdata": Endpoint("https://msg.volkswagen.de/fs-car/promoter/portfolio/v1/$type/$country/vehicle/$vin/carportdata", "carport", "GET"),
+        "rights": Endpoint("https://mal-1a.prd.ece.vwg-connect.com/api/rolesrights/operationlist/v3/vehicles/$vin", "rights", "GET"),
+        "homeRegion": Endpoint("https://mal-1a.prd.ece.vwg-connect.com/api/cs/vds/v1/vehicles/$vin/homeRegion", "app", "GET"),
+        "vehicles": Endpoint("https://msg.volkswagen.de/fs-car/usermanagement/users/v1/$type/$country/vehicles", "app", "GET"),
+        "exchangeAuthCode": Endpoint("https://tokenrefreshservice.apps.emea.vwapps.io/exchangeAuthCode", "tokenservice", "POST"),
+        "refreshTokens": Endpoint("https://tokenrefreshservice.apps.emea.vwapps.io/refreshTokens", "tokenservice", "POST"),
+        "mbbToken": Endpoint("https://mbboauth-1d.prd.ece.vwg-connect.com/mbbcoauth/mobile/oauth2/v1/token", "mbboauth", "POST"),
+    })
+
 #    # Following does not work yet really, needs adjustments for Skoda
 #    session_base = 'https://www.portal.volkswagen-we.com/'
 #    landing_page_url = session_base + 'portal/en_GB/web/guest/home'
@@ -338,103 +1245,258 @@ class SkodaAdapter:
         
 
     async def updateValues(self, mqttc):
-        while True:
-            for vin in self.vehicleStates.keys():
+        # one poll cycle, repeated by the TaskSupervisor
+        cycleStart = time.perf_counter()
+        published = 0
+        fetched = set()
+        for vin in list(self.vehicles):
+            # a failing car must not keep the others from being polled
+            try:
+                if await self.fetchVehicle(vin):
+                    fetched.add(vin)
+            except (HTTPCodeException, requests.exceptions.RequestException) as e:
+                _LOGGER.warning("Could not poll %s: %r", vin, e)
+
+        for vin in list(self.vehicleStates.keys()):
+            # values that were not fetched again are only republished, not recorded again
+            published += self.publishVehicle(mqttc, vin, record = vin in fetched)
+
+        if self.history:
+            self.stats["historyRows"] = await self.history.flush()
+        self.stats["cycleMs"] = round((time.perf_counter() - cycleStart) * 1000, 1)
+        self.stats["published"] = published
+        _LOGGER.info("Poll cycle: %d vehicles, %d values published in %.1f ms (%d log lines suppressed)", len(self.vehicleStates), published, self.stats["cycleMs"], logStats()["logSuppressed"])
+        if time.time() - self.snapshotSaved > self.snapshotInterval:
+            await self.saveSnapshotAsync()
+
+    async def pollVehicle(self, vin):
+        """Poll the status (and position) of `vin`, return whether new status data came in."""
+        if time.time() < self.throttledUntil:
+            return False # the known values are published again meanwhile
+        self.lastPoll[vin] = time.time()
+        fetched = False
+        try:
+            poll = self.getVehicleStatus if vin in self.vehiclesReady else self.setupVehicle
+            try:
+                fetched = await poll(vin) is not False
+            except HTTPCodeException as e:
+                if(e.code != 401):
+                    raise
+                await self.login()
+                fetched = await poll(vin) is not False
+            if self.geofences:
                 try:
-                    await self.getVehicleStatus(vin)
+                    await self.getVehiclePosition(vin)
                 except HTTPCodeException as e:
-                    if(e.code == 401):
-                        await self.login()
-                        await self.getVehicleStatus(vin)
-                        pass
-
-
-            for vin,stateDict in self.vehicleStates.items():
-                publishdict = {}
-                mainjtopic = "skoda2mqtt/%s/JSTATE" % vin
-                mainstopic = "skoda2mqtt/%s/JSTATE"% vin
-                mainctopic = "homeassistant/sensor/skoda2mqtt/%s/config" % vin
-                maincpayload = '{"state_topic": "%s","json_attributes_topic": "%s", "unique_id": "s2m_%s", "name": "S2M_%s", "value_template": "{{ value_json.GENERAL_STATUS }}" }' % (
-                    mainstopic, mainjtopic,
-                    vin,
-                    vin
-                )
-                #mqttc.publish(
-                #    mainctopic,
-                #    maincpayload
-                #)
-                status = 2 # locked
-                for stateId,state in stateDict.items():
-                    if stateId in self.statusValues and state != "" and ("textId" not in state or stateId in self.statusValues and  not re.match(r".*(?:(?:(un)|(not_)supported)|(?:invalid)).*", state["textId"])):
-                        if "textId" not in state or "." in state["textId"]:
-                            state["textId"] = state["value"]
-                        if "calc" in self.statusValues[stateId]:
-                            state["value"] = self.statusValues[stateId]["calc"](state["value"])
-                        _LOGGER.info("%s -> %s(%s)" %(self.statusValues[stateId]["statusName"], state["textId"], state["value"]))
-                        stopic = "skoda2mqtt/%s_%s/STATE"% (vin, self.statusValues[stateId]["statusName"])
-                        spayload = "%s(%s)" %(state["textId"], state["value"]) if state["textId"] != state["value"] else state["value"]
-                        if stateId not in self.configured:
-                            self.configured.append(stateId)
-                            ctopic = "homeassistant/sensor/skoda2mqtt/%s_%s/config" % (vin, self.statusValues[stateId]["statusName"])
-                            cpayload = {
-                                "state_topic": stopic,
-                                "unique_id": "s2m_%s_%s" %(vin, self.statusValues[stateId]["statusName"]),
-                                "name": "s2m_%s_%s" % (vin, self.statusValues[stateId]["statusName"])
-                            }
-
-                            if "unit_of_measurement" in self.statusValues[stateId] and self.statusValues[stateId]["unit_of_measurement"] != "":
-                                cpayload["unit_of_measurement"] = self.statusValues[stateId]["unit_of_measurement"]
-
-                            mqttc.publish(ctopic, json.dumps(cpayload))
-                        mqttc.publish(stopic, spayload)
-
-                        publishdict[self.statusValues[stateId]["statusName"]] = {"value": state["value"], "textId": state["textId"]};
-                        for sl in STATLIMITS:
-                            if(re.match(sl["mask"], self.statusValues[stateId]["statusName"]) and sl["check"] != state["textId"]):
-                                status = sl["fail"] if status > sl["fail"] else status
-                publishdict["GENERAL_STATUS"] = ["open", "closed", "locked"][status]
-
-                #mqttc.publish(
-                #    mainjtopic,
-                #    json.dumps(publishdict)
-                #)
-
-            await asyncio.sleep(60)
+                    _LOGGER.warning("Could not get position of %s: %s", vin, e.message)
+        except VWThrottledException:
+            self.throttledUntil = time.time() + self.throttleWait
+            _LOGGER.warning("Polling throttled, pausing it for %d s", self.throttleWait)
+        return fetched
+
+    async def fetchVehicle(self, vin):
+        """Poll the status of `vin`, joining a poll of it already in flight; return whether new data came in."""
+        task = self.inflight.get(vin)
+        if task is None:
+            task = self.inflight[vin] = asyncio.ensure_future(self.pollVehicle(vin))
+            task.add_done_callback(lambda t: self.inflight.pop(vin, None))
+        return await asyncio.shield(task)
+
+    async def onRefresh(self, mqttc, topic, payload):
+        # skoda2mqtt/<vin>/refresh or skoda2mqtt/refresh for all vehicles
+        if "atoken" not in self.vwtokens:
+            return # not logged in yet
+        parts = topic.split("/")
+        vins = [parts[1]] if len(parts) == 3 else list(self.vehicleStates.keys())
+        refreshes = []
+        for vin in vins:
+            if vin in self.vehicleStates and vin not in self.refreshPending:
+                self.refreshPending.add(vin)
+                refreshes.append(self.refresh(mqttc, vin))
+        await asyncio.gather(*refreshes)
+
+    async def refresh(self, mqttc, vin):
+        # further refresh commands for vin are coalesced into this one until the poll starts
+        requested = time.time()
+        try:
+            await asyncio.sleep(max(self.refreshDebounce, self.lastPoll.get(vin, 0) + self.refreshMinInterval - requested))
+        finally:
+            self.refreshPending.discard(vin)
+        if self.lastPoll.get(vin, 0) >= requested:
+            # the poll cycle got there first, its data is as fresh as the command asked for
+            # and is recorded by the cycle
+            _LOGGER.info("Refresh of %s answered by the last poll", vin)
+            if vin in self.inflight:
+                await asyncio.shield(self.inflight[vin])
+            self.publishVehicle(mqttc, vin, record = False)
+        else:
+            _LOGGER.info("Refreshing %s on request", vin)
+            self.publishVehicle(mqttc, vin, record = await self.fetchVehicle(vin))
+
+    def publishSensor(self, mqttc, vin, name, value, unit = ""):
+        stopic = "skoda2mqtt/%s_%s/STATE"% (vin, name)
+        ctopic = "homeassistant/sensor/skoda2mqtt/%s_%s/config" % (vin, name)
+        if ctopic not in self.configured:
+            self.configured.append(ctopic)
+            cpayload = {
+                "state_topic": stopic,
+                "unique_id": "s2m_%s_%s" %(vin, name),
+                "name": "s2m_%s_%s" % (vin, name)
+            }
+
+            if unit != "":
+                cpayload["unit_of_measurement"] = unit
+
+            mqttc.publish(ctopic, json.dumps(cpayload))
+        mqttc.publish(stopic, value)
+
+    def publishZones(self, mqttc, vin):
+        # while the car is moving its position is unknown, zones stay as they were
+        if self.positions[vin] is not None:
+            zones = set(self.geofences.zonesAt(*self.positions[vin]))
+            if vin in self.zones:
+                for event, changed in [("exit", self.zones[vin] - zones), ("enter", zones - self.zones[vin])]:
+                    for zone in sorted(changed):
+                        _LOGGER.info("%s: %s %s", vin, event, zone)
+                        mqttc.publish("skoda2mqtt/%s/geofence" % vin, json.dumps({"event": event, "zone": zone, "time": int(time.time())}))
+            self.zones[vin] = zones
+        if vin in self.zones:
+            self.publishSensor(mqttc, vin, "ZONE", ",".join(sorted(self.zones[vin])) or "none")
+
+    def publishVehicle(self, mqttc, vin, record = True):
+        # record = False republishes known values (e.g. from the snapshot) without adding them to recent/history again
+        published = 0
+        stateDict = self.vehicleStates[vin]
+        publishdict = {}
+        mainjtopic = "skoda2mqtt/%s/JSTATE" % vin
+        mainstopic = "skoda2mqtt/%s/JSTATE"% vin
+        mainctopic = "homeassistant/sensor/skoda2mqtt/%s/config" % vin
+        maincpayload = '{"state_topic": "%s","json_attributes_topic": "%s", "unique_id": "s2m_%s", "name": "S2M_%s", "value_template": "{{ value_json.GENERAL_STATUS }}" }' % (
+            mainstopic, mainjtopic,
+            vin,
+            vin
+        )
+        #mqttc.publish(
+        #    mainctopic,
+        #    maincpayload
+        #)
+        status = 2 # locked
+        for stateId,state in stateDict.items():
+            if stateId in self.statusValues and state != "" and ("textId" not in state or stateId in self.statusValues and  not re.match(r".*(?:(?:(un)|(not_)supported)|(?:invalid)).*", state["textId"])):
+                # the stored state is left untouched, so publishing it twice gives the same result
+                textId = state["value"] if "textId" not in state or "." in state["textId"] else state["textId"]
+                value = self.statusValues[stateId]["calc"](state["value"]) if "calc" in self.statusValues[stateId] else state["value"]
+                _LOGGER.debug("%s: %s -> %s(%s)", vin, self.statusValues[stateId]["statusName"], textId, value, extra={"ratekey": (vin, stateId)})
+                spayload = "%s(%s)" %(textId, value) if textId != value else value
+                self.publishSensor(mqttc, vin, self.statusValues[stateId]["statusName"], spayload, self.statusValues[stateId].get("unit_of_measurement", ""))
+                published += 1
+
+                publishdict[self.statusValues[stateId]["statusName"]] = {"value": value, "textId": textId};
+                if record:
+                    self.recent.record(vin, self.statusValues[stateId]["statusName"], value)
+                if record and self.history:
+                    self.history.record(vin, self.statusValues[stateId]["statusName"], value)
+                for sl in STATLIMITS:
+                    if(re.match(sl["mask"], self.statusValues[stateId]["statusName"]) and sl["check"] != textId):
+                        status = sl["fail"] if status > sl["fail"] else status
+        publishdict["GENERAL_STATUS"] = ["open", "closed", "locked"][status]
+        if self.stateTimes.get(vin):
+            self.publishSensor(mqttc, vin, "DATA_AGE", int(self.dataAge(vin)), "s")
+        if self.geofences and vin in self.positions:
+            self.publishZones(mqttc, vin)
+
+        #mqttc.publish(
+        #    mainjtopic,
+        #    json.dumps(publishdict)
+        #)
+        return published
 
     async def getVehicleStatus(self, vin):
-        url = await self.replaceVarInUrl("$homeregion/fs-car/bs/vsr/v1/$type/$country/vehicles/$vin/status", vin)
-        accept = "application/json"
-        r = (await self.execRequest({
-            "url": url,
-            "headers": {
-                    "User-Agent": "okhttp/3.7.0",
-                    "X-App-Version": self.config["xappversion"],
-                    "X-App-Name": self.config["xappname"],
-                    "Authorization": "Bearer " + self.vwtokens["atoken"],
-                    "Accept-charset": "UTF-8",
-                    "Accept": accept,
-            }
-        })).json()
+        r = (await self.request("status", vin)).json()
         if "StoredVehicleDataResponse" not in r or "vehicleData" not in r["StoredVehicleDataResponse"] or "data" not in r["StoredVehicleDataResponse"]["vehicleData"]:
             return False
         self.vehicleStates[vin] = dict([(e["id"],e if "value" in e else "") for f in [s["field"] for s in r["StoredVehicleDataResponse"]["vehicleData"]["data"]] for e in f])
+        now = time.time()
+        self.stateTimes[vin] = dict([(k, parseUtc(e.get("tsCarSentUtc")) or now) for k, e in self.vehicleStates[vin].items() if e != ""])
 
 
 
+    async def getVehiclePosition(self, vin):
+        """Return (latitude, longitude) of the parked car, None while it is moving."""
+        entry = next(e for e in self.statesArray if e["path"] == "position")
+        r = await self.request("position", vin)
+        if r.status_code == 204: # no position while moving
+            self.positions[vin] = None
+            return None
+        result = r.json()
+        for el in ["element", "element2", "element3", "element4"]:
+            if el in entry and entry[el] in result:
+                result = result[entry[el]]
+        if "carCoordinate" not in result:
+            return None
+        position = (result["carCoordinate"]["latitude"] / 1e6, result["carCoordinate"]["longitude"] / 1e6)
+        self.positions[vin] = position
+        for field, value in zip(["POSITION_LATITUDE", "POSITION_LONGITUDE"], position):
+            self.recent.record(vin, field, value)
+            if self.history:
+                self.history.record(vin, field, value)
+        return position
+
+    async def updateTrips(self, mqttc):
+        # one round, repeated by the TaskSupervisor
+        for vin in self.vehicles:
+            try:
+                if await self.getTrips(vin):
+                    await asyncio.get_running_loop().run_in_executor(None, self.trips.save)
+            except HTTPCodeException as e:
+                _LOGGER.warning("Could not get trips of %s: %s", vin, e.message)
+            if vin in self.trips.vehicles:
+                self.publishTrips(mqttc, vin)
+
+    async def getTrips(self, vin):
+        """Fold the trips newer than the last one seen into the trip statistics.
+
+        The API has no way to ask for trips after a given one, so the newest
+        trip is checked first and the list only fetched if it is unknown."""
+        entry = next(e for e in self.statesArray if e["path"] == "tripdata")
+        cursor = self.trips.cursor(vin)
+        if cursor is not None:
+            r = await self.request("tripdata", vin, query = "?newest")
+            if r.status_code == 204 or r.json().get("tripData", {}).get("tripID") == cursor:
+                return 0
+        r = await self.request("tripdata", vin, params = {"type": "list"})
+        if r.status_code == 204:
+            return 0
+        trips = r.json()[entry["element"]]["tripData"]
+        added = self.trips.add(vin, trips)
+        _LOGGER.info("%s: %d new trips", vin, len(added))
+        for trip in added:
+            if self.history:
+                self.history.record(vin, "TRIP_DISTANCE", trip.get("mileage", 0), parseUtc(trip.get("timestamp")), changesOnly = False)
+        return len(added)
+
+    def publishTrips(self, mqttc, vin):
+        stats = self.trips.vehicles[vin]
+        buckets = [("TOTAL", stats["total"]), ("TODAY", stats["daily"].get(time.strftime("%Y-%m-%d", time.gmtime()))), ("MONTH", stats["monthly"].get(time.strftime("%Y-%m", time.gmtime())))]
+        for name, bucket in buckets:
+            summary = TripStatistics.summary(bucket)
+            self.publishSensor(mqttc, vin, "TRIPS_%s_COUNT" % name, summary["trips"])
+            self.publishSensor(mqttc, vin, "TRIPS_%s_DISTANCE" % name, summary["distance"], "km")
+            self.publishSensor(mqttc, vin, "TRIPS_%s_AVERAGE_SPEED" % name, summary["averageSpeed"], "km/h")
+            self.publishSensor(mqttc, vin, "TRIPS_%s_AVERAGE_CONSUMPTION" % name, summary["averageConsumption"], "l/100km")
+            self.publishSensor(mqttc, vin, "TRIPS_%s_AVERAGE_ELECTRIC_CONSUMPTION" % name, summary["averageElectricConsumption"], "kWh/100km")
+        self.publishSensor(mqttc, vin, "TRIPS_LAST_DISTANCE", stats["lastDistance"], "km")
+        mqttc.publish("skoda2mqtt/%s/trips" % vin, json.dumps({
+            "daily": dict([(k, TripStatistics.summary(v)) for k, v in stats["daily"].items()]),
+            "monthly": dict([(k, TripStatistics.summary(v)) for k, v in stats["monthly"].items()])
+        }))
+
     async def getVehicleStatus_orig(self, vin, url, path, element, element2, element3, element4):
         url = await self.replaceVarInUrl(url, vin)
-        accept = "application/json"
         try:
             r = await self.execRequest({
                 "url": url,
-                "headers": {
-                    "User-Agent": "okhttp/3.7.0",
-                    "X-App-Version": self.config["xappversion"],
-                    "X-App-Name": self.config["xappname"],
-                    "Authorization": "Bearer " + self.vwtokens["atoken"],
-                    "Accept-charset": "UTF-8",
-                    "Accept": accept,
-                },
+                "headers": self.profiles.headers["app"],
                 "method": "GET"
             })
         except HTTPCodeException as e:
@@ -486,37 +1548,12 @@ class SkodaAdapter:
         return nurl
 
     async def getVehicleData(self,vin):
-        url = await self.replaceVarInUrl("https://msg.volkswagen.de/fs-car/promoter/portfolio/v1/$type/$country/vehicle/$vin/carportdata", vin)
-        r = await self.execRequest({
-            "url": url,
-            "method": "GET",
-            "headers": {
-                "User-Agent": "okhttp/3.7.0",
-                "X-App-Version": self.config["xappversion"],
-                "X-App-Name": self.config["xappname"],
-                "X-Market": "de_DE",
-                "Authorization": "Bearer " + self.vwtokens["atoken"],
-                "Accept": "application/json",
-            },
-            "followAllRedirects": True
-        })
+        r = await self.request("carportdata", vin)
         self.vehicleData[vin] = r.json()
         return r
 
     async def getVehicleRights(self,vin):
-        url = "https://mal-1a.prd.ece.vwg-connect.com/api/rolesrights/operationlist/v3/vehicles/" + vin
-        r = await self.execRequest({
-            "url": url,
-            "headers": {
-                "User-Agent": "okhttp/3.7.0",
-                "X-App-Version": self.config["xappversion"],
-                "X-App-Name": self.config["xappname"],
-                "Authorization": "Bearer " + self.vwtokens["atoken"],
-                "Accept": "application/json, application/vnd.vwg.mbb.operationList_v3_0_2+xml, application/vnd.vwg.mbb.genericError_v1_0_2+xml"
-            },
-            "method": "GET",
-            "followAllRedirects": True
-        })
+        r = await self.request("rights", vin)
         self.vehicleRights[vin] = r.json()
         return r
 
@@ -526,67 +1563,51 @@ class SkodaAdapter:
     async def loadTokens(self):
         pass # TODO
 
-    async def requestStatusUpdate(self, vin = ""):
-        
-        key = "skoda2mqtt.requestStatusUpdateTS"
-        tsfile = Path(key)
-        if tsfile.is_file():
-            tsfile = open(key, "r")
-            ts = int(tsfile.read())
-            tsfile.close()
-        else:
-            ts = 0
+    async def requestStatusUpdate(self, vin):
+        # asks the car to send fresh data; scheduling and throttling is up to WakeupScheduler
+        if "homeregion" not in self.config:
+            await self.getHomeRegion(vin)
 
-        if ts + RSU_INTERVAL > int(time.time()): # RSU_INTERVAL not passed yet...
-            return
-        else:
-            await store.async_save(int(time.time()))
+        return await self.request("requests", vin)
 
-        if self.throttle_wait > int(time.time()):
-            return
-        if vin == "":
-            vin = self.vehicles[0]
+    def dataAge(self, vin, now = None):
+        """Seconds since the car last sent its status, infinite if unknown."""
+        if not self.stateTimes.get(vin):
+            return math.inf
+        return (now or time.time()) - max(self.stateTimes[vin].values())
 
-        if vin not in self.vehicleHomeRegions:
-            await self.getHomeRegion(vin)
+    def saveSnapshot(self):
+        writeJsonAtomic(self.snapshotFile, {"savedAt": time.time(), "states": self.vehicleStates, "times": self.stateTimes})
+        self.snapshotSaved = time.time()
 
-        url = await self.replaceVarInUrl("$homeregion/fs-car/bs/vsr/v1/$type/$country/vehicles/%s/requests"% vin)
-        accept = "application/json"
+    async def saveSnapshotAsync(self):
+        # serialize here, the states may change while the file is written
+        text = json.dumps({"savedAt": time.time(), "states": self.vehicleStates, "times": self.stateTimes})
+        await asyncio.get_running_loop().run_in_executor(None, writeFileAtomic, self.snapshotFile, text)
+        self.snapshotSaved = time.time()
+
+    def loadSnapshot(self):
+        """Restore vehicleStates from the last snapshot, return its age in seconds or None."""
         try:
-            r = await self.execRequest({
-                "url": url,    
-                "headers": {
-                    "User-Agent": "okhttp/3.7.0",
-                    "X-App-Version": self.config["xappversion"],
-                    "X-App-Name": self.config["xappname"],
-                    "Authorization": "Bearer " + self.vwtokens["atoken"],
-                    "Accept": accept,
-                    "Accept-charset": "UTF-8"
-                    },
-                "followAllRedirects": True,
-                "method": "POST"
-            })
-            self.throttle_wait = int(time.time()) + 30*60
-            return r;
-        except VWThrottledException:
-            self.throttle_wait = int(time.time()) + 30*60
-            pass
+            with open(self.snapshotFile, "r") as f:
+                snap = json.load(f)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return None
+        try:
+            states, times, age = dict(snap["states"]), dict(snap["times"]), time.time() - snap["savedAt"]
+            if not all(isinstance(v, dict) for v in list(states.values()) + list(times.values())):
+                raise TypeError("vehicle entries must be objects")
+        except (KeyError, TypeError, AttributeError, ValueError) as e:
+            _LOGGER.warning("Ignoring snapshot %s, starting without it: %r", self.snapshotFile, e)
+            return None
+        self.vehicleStates.update(states)
+        self.stateTimes.update(times)
+        return age
 
     async def getHomeRegion(self, vin = ""):
         if vin == "":
             vin = self.vehicles[0]
-        r = await self.execRequest({ 
-            "url": "https://mal-1a.prd.ece.vwg-connect.com/api/cs/vds/v1/vehicles/%s/homeRegion" % vin, 
-            "method": "GET", 
-            "headers": {
-                "user-agent": "okhttp/3.7.0", 
-                "X-App-Version": self.config["xappversion"],
-                "X-App-Name": self.config["xappname"],
-                "Authorization": "Bearer " + self.vwtokens["atoken"], 
-                "Accept":  "application/json"
-            }, 
-            "followAllRedirects": True
-        })
+        r = await self.request("homeRegion", vin)
         self.config["homeregion"] = r.json()['homeRegion']['baseUri']['content'].split("/api")[0].replace("mal-", "fal-") if r.json()['homeRegion']['baseUri']['content'] != "https://mal-1a.prd.ece.vwg-connect.com/api" else "https://msg.volkswagen.de"
         return r
 
@@ -595,19 +1616,7 @@ class SkodaAdapter:
 
 
     async def getVehicles(self):
-        url = await self.replaceVarInUrl("https://msg.volkswagen.de/fs-car/usermanagement/users/v1/$type/$country/vehicles")
-        headers = {
-            "User-Agent": "okhttp/3.7.0",
-            "X-App-Version": self.config["xappversion"],
-            "X-App-Name": self.config["xappname"],
-            "Authorization": "Bearer " + self.vwtokens["atoken"],
-            "Accept": "application/json",
-        }
-        r = await self.execRequest({
-            "url": url,
-            "headers": headers,
-            "allowRedirects": True
-        })
+        r = await self.request("vehicles", allowRedirects = True)
         self.vehicles = r.json()['userVehicles']['vehicle']
         return r.json()
 
@@ -638,20 +1647,9 @@ class SkodaAdapter:
                 "id_token":  tokens['jwtid_token'],
                 "brand": "skoda"
         }
-        url = "https://tokenrefreshservice.apps.emea.vwapps.io/exchangeAuthCode"
 
         _LOGGER.info("Retrieving tokens...")
-        r = await self.execRequest({
-            "method": "POST",
-            "url": url,
-            "headers": {
-                "X-App-version": self.config["xappversion"],
-                "content-type": "application/x-www-form-urlencoded",
-                "x-app-name": self.config["xappname"],
-                "accept": "application/json"
-            },
-            "params": body
-        })
+        r = await self.request("exchangeAuthCode", params = body)
 
         _LOGGER.info("Done!")
         vwtok = r.json()
@@ -667,20 +1665,11 @@ class SkodaAdapter:
 
 
     async def refreshToken(self):
-        url = "https://tokenrefreshservice.apps.emea.vwapps.io/refreshTokens"
         data = { 
             "refresh_token": self.vwtokens["rtoken"]
         }
-        rtokens = (await self.execRequest({
-            "url": url,
-            "headers": self.HEADERS("session"),
-            "method": "POST",
-            "data": data,
-            "followAllRedirects": True
-        })).json()
-        self.vwtokens["atoken"] = rtokens["access_token"]
-        if "refresh_token" in rtokens:
-            self.vwtokens["rtoken"] = rtokens["refresh_token"]
+        rtokens = (await self.request("refreshTokens", params = data)).json()
+        self.setTokens(rtokens["access_token"], rtokens.get("refresh_token"))
 
 
 
@@ -689,30 +1678,17 @@ class SkodaAdapter:
 
     async def getVWTokens(self, tokens, jwtid_token):
 
-        self.vwtokens["atoken"] = tokens["access_token"]
-        self.vwtokens["rtoken"] = tokens["refresh_token"]
+        self.setTokens(tokens["access_token"], tokens["refresh_token"])
         _LOGGER.info("Retrieving VW tokens...")
-        r1 = await self.execRequest({
-            "url": "https://mbboauth-1d.prd.ece.vwg-connect.com/mbbcoauth/mobile/oauth2/v1/token",
-            "headers": {
-                "User-Agent": "okhttp/3.7.0",
-                "X-App-Version": self.config["xappversion"],
-                "X-App-Name": self.config["xappname"],
-                "X-Client-Id": self.config["xClientId"],
-                "Host": "mbboauth-1d.prd.ece.vwg-connect.com",
-            },
-            "params": {
+        r1 = await self.request("mbbToken", params = {
                 "grant_type": "id_token",
                 "token": jwtid_token,
                 "scope": "sc2:fal",
-            },
-            "method": "POST"
-        })
+            })
         _LOGGER.info("Done!")
         if r1.status_code < 400:
             rtokens = r1.json()
-            self.vwtokens["atoken"] = rtokens["access_token"]
-            self.vwtokens["rtoken"] = rtokens["refresh_token"]
+            self.setTokens(rtokens["access_token"], rtokens["refresh_token"])
             _LOGGER.info("Tokens OK")
         else:
             _LOGGER.info("Tokens wrong...")
@@ -720,6 +1696,20 @@ class SkodaAdapter:
 
 
 
+    def setTokens(self, atoken, rtoken = None):
+        self.vwtokens["atoken"] = atoken
+        if rtoken:
+            self.vwtokens["rtoken"] = rtoken
+        self.profiles.setBearer(atoken)
+
+    async def request(self, endpoint, vin = "", query = "", **req):
+        """execRequest on one of self.endpoints, with the headers of its profile."""
+        ep = self.endpoints[endpoint]
+        req["url"] = await self.replaceVarInUrl(ep.url, vin) + query
+        req["headers"] = self.profiles.headers[ep.profile]
+        req["method"] = ep.method
+        return await self.execRequest(req)
+
     async def getNonce(self):
         ts = "%d" % (time.time())
         sha256 = hashlib.sha256()
@@ -793,13 +1783,8 @@ class SkodaAdapter:
                     #state: "fec823d30dda438b915d2f55934566a8",
                     "state": await self.getNonce() # questionable...
                 },
-                "headers": {
-                    # ":authority:": "identity.vwgroup.io", # does not work in python-requests
-                    "user-agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 13_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148",
-                    "accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-                    "accept-language": "de-de",
-                    "acccept-encoding": "gzip, deflate, br"
-                },
+                # ":authority:": "identity.vwgroup.io", # does not work in python-requests
+                "headers": self.profiles.headers["browser"],
                 "method": "GET",
                 "allow_redirects": True
         })
@@ -819,13 +1804,10 @@ class SkodaAdapter:
         postemail = await self.execRequest( {
                 "url": pe_url,
                 "params": mailform,
-                "headers": {
-                    "accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.82",
-                    "origin": getconfig["issuer"], # "issuer" from config
-                    "accept-language": "de-de",
-                    "user-agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 13_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148",
-                    "referer": getauth.url
-                },
+                "headers": dict(self.profiles.headers["browser"],
+                    origin = getconfig["issuer"], # "issuer" from config
+                    referer = getauth.url
+                ),
                 "method": "POST"
         })
 
@@ -848,15 +1830,12 @@ class SkodaAdapter:
             postpw = await self.execRequest({
                 "url": ppwurl,
                 "params": pwform,
-                "headers": {
-                    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-                    "Content-Type": "application/x-www-form-urlencoded",
+                "headers": dict(self.profiles.headers["browser"], **{
+                    "content-type": "application/x-www-form-urlencoded",
                     "origin": getconfig["issuer"], # "issuer" from config
-                    "accept-language": "de-de",
-                    "user-agent": "Mozilla/5.0 (iPhone; CPU iPhone OS 13_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148",
                     "accept-encoding":  "gzip, deflate, br",
                     "referer": postemail.url
-                },
+                }),
                 "method": "POST",
                 "allowRedirects": True
             })
@@ -909,20 +1888,57 @@ class SkodaAdapter:
         }
         self.config["email"] = email
         self.config["password"] = password
+        self.profiles = RequestProfiles(self.config)
+
+        # per instance, a reloaded config may bring a second adapter
+        self.vwtokens = {}
+        self.vehicles = []
+        self.vehicleData = {}
+        self.vehicleRights = {}
+        self.vehicleHomeRegions = {}
+        self.vehicleStates = {}
+        self.stateTimes = {}
+        self.configured = []
+        self.stats = {}
+        self.inflight = {}
+        self.lastPoll = {}
+        self.refreshPending = set()
+        self.positions = {}
+        self.zones = {}
+        self.initialized = False
+        self.vehiclesReady = set()
 
     async def init(self):
-        if len(self.vehicles) == 0:
-            await self.login()
+        # self.vehicles is set before the per-car steps, so a failed init is told by its own flag
+        if not self.initialized:
+            if "atoken" not in self.vwtokens:
+                await self.login()
             v = (await self.getVehicles())['userVehicles']['vehicle']
+            for vin in [vin for vin in self.vehicleStates if vin not in self.vehicles]:
+                del self.vehicleStates[vin] # restored from a snapshot, but gone from the account
+                self.stateTimes.pop(vin, None)
             for car in self.vehicles:
-                s = await self.getVehicleData(car)
-                t = await self.getVehicleRights(car)
-                hr = await self.getHomeRegion(car)
-                rq = await self.getVehicleStatus(car)
+                # a car failing here is set up by the poller later, the others are polled meanwhile
+                try:
+                    await self.setupVehicle(car)
+                except (HTTPCodeException, requests.exceptions.RequestException) as e:
+                    _LOGGER.warning("Could not set up %s, retrying with the next poll: %r", car, e)
+            self.initialized = True
+
+    async def setupVehicle(self, vin):
+        s = await self.getVehicleData(vin)
+        t = await self.getVehicleRights(vin)
+        hr = await self.getHomeRegion(vin)
+        rq = await self.getVehicleStatus(vin)
+        self.vehiclesReady.add(vin)
+        return rq
 
 
 
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        asyncio.run(main())
+    finally:
+        _LOG_LISTENER.stop()